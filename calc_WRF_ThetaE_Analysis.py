@@ -13,13 +13,110 @@ Modified: 2025.09.24 - Support iterative processing (member-time-level) for memo
 #==================================================================================================
 import numpy as np
 import xarray as xr
-import metpy.calc as mpcalc
+import dask
+import dask.array as da
 from metpy.units import units
+from numba import njit, prange, get_num_threads, set_num_threads, float32, types
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from grid_cache import load_grid_deltas
 import argparse
 import os
 #=========================================================================
 
-def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS):
+@njit(inline='always')
+def _stencil(delta, i, n):
+    """
+    第 i 點的三點差分索引與權重（非均勻間距，與 MetPy first_derivative 相同；端點採單邊差分）
+    
+    三個權重總和為零，只回傳兩側權重 w0, w2；導數為 w0*(f[i0]-f[i1]) + w2*(f[i2]-f[i1])，
+    以差值計算可避免 float32 下相近大數 (如 ~330 K) 相加相消的誤差
+    """
+    if i == 0:
+        d0 = delta[0]
+        d1 = delta[1]
+        c = d0 + d1
+        return 0, 1, 2, -(c + d0) / (c * d0), -d0 / (c * d1)
+    if i == n - 1:
+        d0 = delta[n - 3]
+        d1 = delta[n - 2]
+        c = d0 + d1
+        return n - 3, n - 2, n - 1, d1 / (c * d0), (c + d1) / (c * d1)
+    d0 = delta[i - 1]
+    d1 = delta[i]
+    c = d0 + d1
+    return i - 1, i, i + 1, -d1 / (c * d0), d0 / (c * d1)
+
+
+# 全程 float32（輸入、網格間距與中間量），避免隱式提升為 float64 而加倍記憶體頻寬
+_KERNEL_SIGNATURE = types.UniTuple(float32[:, :, ::1], 5)(
+    float32[:, :, :], float32[:, :, :], float32[:, :, :], float32[:, :], float32[:, :])
+
+
+# fastmath 不含 nnan/ninf：地面以下的 NaN 格點需依 IEEE 規則傳遞
+@njit(_KERNEL_SIGNATURE, parallel=True, fastmath={'contract', 'arcp', 'reassoc', 'afn'}, cache=True)
+def calc_derivatives_kernel(eth, u, v, dx, dy):
+    """
+    單次掃描計算相當位溫梯度、輻散與渦度（沿批次×格點列平行，單一切片也能使用所有核心）
+    
+    Parameters:
+    -----------
+    eth, u, v : float32 ndarray (N, ny, nx)
+        相當位溫 [K] 與風場 [m/s]
+    dx : float32 ndarray (ny, nx-1)
+        x 方向網格間距 [m]
+    dy : float32 ndarray (ny-1, nx)
+        y 方向網格間距 [m]
+    
+    Returns:
+    --------
+    dtedx, dtedy, absthe, divg, vort : ndarray (N, ny, nx)
+    """
+    n, ny, nx = eth.shape
+    dtedx = np.empty_like(eth)
+    dtedy = np.empty_like(eth)
+    absthe = np.empty_like(eth)
+    divg = np.empty_like(eth)
+    vort = np.empty_like(eth)
+
+    for kj in prange(n * ny):
+        k = kj // ny
+        j = kj % ny
+        for i in range(nx):
+            i0, i1, i2, a0, a2 = _stencil(dx[j], i, nx)
+            j0, j1, j2, b0, b2 = _stencil(dy[:, i], j, ny)
+
+            gx = a0 * (eth[k, j, i0] - eth[k, j, i1]) + a2 * (eth[k, j, i2] - eth[k, j, i1])
+            gy = b0 * (eth[k, j0, i] - eth[k, j1, i]) + b2 * (eth[k, j2, i] - eth[k, j1, i])
+            dudx = a0 * (u[k, j, i0] - u[k, j, i1]) + a2 * (u[k, j, i2] - u[k, j, i1])
+            dudy = b0 * (u[k, j0, i] - u[k, j1, i]) + b2 * (u[k, j2, i] - u[k, j1, i])
+            dvdx = a0 * (v[k, j, i0] - v[k, j, i1]) + a2 * (v[k, j, i2] - v[k, j, i1])
+            dvdy = b0 * (v[k, j0, i] - v[k, j1, i]) + b2 * (v[k, j2, i] - v[k, j1, i])
+
+            dtedx[k, j, i] = gx
+            dtedy[k, j, i] = gy
+            absthe[k, j, i] = np.sqrt(gx * gx + gy * gy)
+            divg[k, j, i] = dudx + dvdy
+            vort[k, j, i] = dvdx - dudy
+
+    return dtedx, dtedy, absthe, divg, vort
+
+
+def calc_derivatives_block(eth, u, v, dx, dy, n_threads=0):
+    """
+    xr.apply_ufunc 用：將前置維度攤平成批次後呼叫 kernel，再還原成原本形狀
+    n_threads > 0 時限制 kernel 使用的執行緒數（多行程時避免核心超額使用）
+    """
+    if n_threads > 0:
+        set_num_threads(n_threads)
+    shape = eth.shape
+    ny, nx = shape[-2:]
+    results = calc_derivatives_kernel(eth.reshape(-1, ny, nx), u.reshape(-1, ny, nx), v.reshape(-1, ny, nx), dx, dy)
+    return tuple(r.reshape(shape) for r in results)
+
+#=========================================================================
+
+def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS, N_WORKERS=1):
     """
     逐成員、逐時間、逐層處理資料並輸出到同一個檔案
     
@@ -31,6 +128,8 @@ def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS):
         輸出檔案路徑
     LEVELS : list
         氣壓層列表 (hPa)
+    N_WORKERS : int
+        平行處理成員的行程數 (1: 單一行程，由 kernel 使用所有核心)
     """
     print(f"\n=== Processing Multiple Levels Iteratively: {LEVELS} hPa ===")
     print(f"Reading data from: {INPUT_DIR}")
@@ -44,17 +143,20 @@ def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS):
     for key, path in input_file.items():
         print(f"  {key}: {path}")
 
-    # 開啟資料集（保持開啟以便逐一讀取）
+    # 開啟資料集（dask 延遲讀取，區塊對齊處理單位：單一行程逐成員逐時間，多行程逐成員）
     print(f"Opening datasets...")
-    ds_eth = xr.open_dataset(input_file['eth'])
-    ds_wind = xr.open_dataset(input_file['uv'])
+    chunks_in = {'member': 1, 'Time': 1 if N_WORKERS == 1 else -1, 'interp_level': -1,
+                 'south_north': -1, 'west_east': -1}
+    ds_eth = xr.open_dataset(input_file['eth'], chunks=chunks_in)
+    ds_wind = xr.open_dataset(input_file['uv'], chunks=chunks_in)
     
     # 讀取基本座標資訊
     lons = ds_eth['XLONG'].values * units('degree')
     lats = ds_eth['XLAT'].values * units('degree')
     times = ds_eth['Time'].values
     members = ds_eth['member'].values
-    available_levels = ds_eth['interp_level'].values
+    # 兩個檔案都有的氣壓層才可處理
+    available_levels = np.intersect1d(ds_eth['interp_level'].values, ds_wind['interp_level'].values)
 
     print(f"    Available pressure levels: {available_levels}")
     print(f"    Requested levels: {LEVELS}")
@@ -71,146 +173,152 @@ def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS):
     print(f"    Levels: {len(LEVELS)} ({LEVELS})")
     print(f"    Grid size: {lats.shape}")
 
-    # 計算網格間距（一次計算，後續重複使用）
-    dx, dy = mpcalc.lat_lon_grid_deltas(lons, lats)
+    # 計算網格間距（一次計算，後續重複使用；跨次執行由磁碟快取重複使用）
+    dx, dy = load_grid_deltas(lons, lats)
     print(f"    Grid spacing: dx={dx.mean():.1f}, dy={dy.mean():.1f}")
 
-    # 初始化輸出資料陣列
+    # 去除 pint 單位，只保留 [m] 的純數值供 kernel 使用（單位僅寫在輸出變數 attrs）
+    dx_m = dx.m_as('m').astype(np.float32)
+    dy_m = dy.m_as('m').astype(np.float32)
+
     n_members = len(members)
     n_times = len(times)
     n_levels = len(LEVELS)
     ny, nx = lats.shape
 
-    print(f"\n=== Initializing output arrays ===")
+    # 選取要求的氣壓層並排成 (member, Time, level, y, x)；僅建立 dask 延遲陣列，寫檔時才逐塊讀入
+    dims_in = ('member', 'Time', 'interp_level', 'south_north', 'west_east')
+    # 風場依 eth 的成員與時間標籤選取，兩檔排列順序不同時仍逐點對應
+    sel_in = {'member': members, 'Time': times, 'interp_level': LEVELS}
+    eth_in = ds_eth['eth'].sel(sel_in).transpose(*dims_in).astype(np.float32, copy=False).data
+    u_in = ds_wind['ua'].sel(sel_in).transpose(*dims_in).astype(np.float32, copy=False).data
+    v_in = ds_wind['va'].sel(sel_in).transpose(*dims_in).astype(np.float32, copy=False).data
+
+    print(f"\n=== Building lazy output fields ===")
     print(f"    Output shape: ({n_members}, {n_times}, {n_levels}, {ny}, {nx})")
+
+    # 輸出時逐塊讀取、計算並寫檔，不需同時配置六個完整輸出陣列
+    dims_5d = ['member', 'Time', 'level', 'south_north', 'west_east']
+    if N_WORKERS > 1:
+        # 多行程：以成員為區塊單位，dask 執行緒負責讀寫檔，kernel 計算交給行程池 (不受 GIL 限制)
+        n_threads = max(1, get_num_threads() // N_WORKERS)
+        # spawn：工作行程由 dask 執行緒中首次 submit 時才啟動，fork 會複製父行程的 Numba/TBB 執行緒狀態
+        pool = ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+        def derivatives_func(*args, **kwargs):
+            return pool.submit(calc_derivatives_block, *args, **kwargs).result()
+
+        scheduler = {'scheduler': 'threads', 'num_workers': N_WORKERS}
+        print(f"    Workers: {N_WORKERS} processes x {n_threads} threads")
+    else:
+        # 單一行程：kernel 內部已使用所有核心，dask 以單執行緒依序排程即可（避免重複進入 Numba 平行區段）
+        n_threads = 0
+        pool = None
+        derivatives_func = calc_derivatives_block
+        scheduler = {'scheduler': 'synchronous'}
+    eth_da = xr.DataArray(eth_in, dims=dims_5d)
+    u_da = xr.DataArray(u_in, dims=dims_5d)
+    v_da = xr.DataArray(v_in, dims=dims_5d)
+    print(f"    Chunks: {eth_da.data.npartitions} x {eth_da.data.chunksize}")
+
+    # 計算相當位溫梯度、divergence and vorticity (融合單次掃描，逐塊執行)
+    core_dims = ['south_north', 'west_east']
+    derived = xr.apply_ufunc(
+        derivatives_func, eth_da, u_da, v_da,
+        kwargs={'dx': dx_m, 'dy': dy_m, 'n_threads': n_threads},
+        input_core_dims=[core_dims] * 3,
+        output_core_dims=[core_dims] * 5,
+        dask='parallelized',
+        output_dtypes=[np.float32] * 5,
+    )
+    output_arrays = dict(zip(['dtedx', 'dtedy', 'absthe', 'divg', 'vort'], derived))
+    output_arrays['eth'] = eth_da
+
+    print(f"\n=== Creating output dataset ===")
+
+    # 建立輸出dataset
+    output_ds = xr.Dataset(
+        coords={
+            'member': members,
+            'Time': times,
+            'level': LEVELS,
+            'XLAT': (['south_north', 'west_east'], lats.magnitude),
+            'XLONG': (['south_north', 'west_east'], lons.magnitude),
+        }
+    )
     
-    # 初始化所有輸出陣列
-    output_arrays = {
-        'eth': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32),
-        'dtedx': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32),
-        'dtedy': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32),
-        'absthe': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32),
-        'divg': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32),
-        'vort': np.full((n_members, n_times, n_levels, ny, nx), np.nan, dtype=np.float32)
+    # 定義變數配置和單位
+    var_configs = {
+        'eth': ('K', 'Equivalent potential temperature'),
+        'dtedx': ('K/m', 'Zonal gradient of equivalent potential temperature'),
+        'dtedy': ('K/m', 'Meridional gradient of equivalent potential temperature'),
+        'absthe': ('K/m', 'Absolute gradient of equivalent potential temperature'),
+        'divg': ('1/s', 'Horizontal divergence'),
+        'vort': ('1/s', 'Relative vorticity')
     }
     
-    total_iterations = n_members * n_times * n_levels
-    current_iteration = 0
+    # 加入所有變數
+    for var_name, (units_str, long_name) in var_configs.items():
+        output_ds[var_name] = output_arrays[var_name]
+        output_ds[var_name].attrs = {
+            'units': units_str,
+            'long_name': long_name,
+            'pressure_levels': f"{LEVELS} hPa"
+        }
+        print(f"    Added variable: {var_name}")
+
+    # 加入全域屬性
+    output_ds.attrs.update({
+        'title': f'Multi-level equivalent potential temperature analysis',
+        'description': f'Derived meteorological variables from WRF data at {LEVELS} hPa levels',
+        'source': f'Processed from {INPUT_DIR}',
+        'pressure_levels': f'{LEVELS} hPa',
+        'processing_date': np.datetime64('now').astype(str),
+        'levels_processed': len(LEVELS),
+        'processing_method': 'Chunked member-time-level processing streamed to NetCDF'
+    })
+
+    print(f"    Writing to NetCDF file: {OUTPUT_FILE}")
     
-    print(f"    Total iterations: {total_iterations}")
-    print(f"    Starting iterative processing...")
-
-    # 三層迴圈：逐成員、逐時間、逐層處理
-    for m_idx, member in enumerate(members):
-        print(f"--- Processing Member {member} ({m_idx+1}/{n_members}) ---")
-        
-        for t_idx, time in enumerate(times):
-            # print(f"  Processing Time {t_idx+1}/{n_times} ({time})...")
-            
-            for l_idx, level in enumerate(LEVELS):
-                current_iteration += 1
-                progress = (current_iteration / total_iterations) * 100
-                                
-                try:
-                    # 讀取當前成員、時間、氣壓層的資料
-                    eth_slice = ds_eth.sel(member=member, Time=time, interp_level=level)['eth'].values * units('K')
-                    u_slice = ds_wind.sel(member=member, Time=time, interp_level=level)['ua'].values * units('m/s')
-                    v_slice = ds_wind.sel(member=member, Time=time, interp_level=level)['va'].values * units('m/s')
-                    
-                    # 計算相當位溫梯度 (2D計算)
-                    dtheta_e_dx, dtheta_e_dy = mpcalc.geospatial_gradient(eth_slice, x_dim=-1, y_dim=-2, dx=dx, dy=dy)
-                    abs_grad_theta_e = np.sqrt(dtheta_e_dx**2 + dtheta_e_dy**2)
-                    
-                    # 計算divergence and vorticity (2D計算)
-                    divergence_field = mpcalc.divergence(u_slice, v_slice, x_dim=-1, y_dim=-2, dx=dx, dy=dy)
-                    vorticity_field = mpcalc.vorticity(u_slice, v_slice, x_dim=-1, y_dim=-2, dx=dx, dy=dy)
-                    
-                    # 將結果儲存到輸出陣列
-                    output_arrays['eth'][m_idx, t_idx, l_idx] = eth_slice.magnitude
-                    output_arrays['dtedx'][m_idx, t_idx, l_idx] = dtheta_e_dx.magnitude
-                    output_arrays['dtedy'][m_idx, t_idx, l_idx] = dtheta_e_dy.magnitude
-                    output_arrays['absthe'][m_idx, t_idx, l_idx] = abs_grad_theta_e.magnitude
-                    output_arrays['divg'][m_idx, t_idx, l_idx] = divergence_field.magnitude
-                    output_arrays['vort'][m_idx, t_idx, l_idx] = vorticity_field.magnitude
-                    
-                except Exception as e:
-                    print(f"      Error processing Member {member}, Time {t_idx+1}, Level {level}: {e}")
-                    continue
+    # 設定編碼格式（shuffle + deflate 壓縮；chunk 對齊逐切片讀取的存取模式）
+    encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 4, 'shuffle': True,
+                      'chunksizes': (1, 1, 1, ny, nx)} for var in output_ds.data_vars}
+
+    # 統計資訊 (nan-aware 延遲歸約)，與寫檔共用同一次逐塊計算
+    stats_lazy = {var_name: (da.nanmin(output_ds[var_name].data),
+                             da.nanmax(output_ds[var_name].data),
+                             da.isnan(output_ds[var_name].data).sum())
+                  for var_name in var_configs}
+
+    # 逐塊計算並寫入
+    try:
+        write_job = output_ds.to_netcdf(OUTPUT_FILE, encoding=encoding, compute=False)
+        with dask.config.set(**scheduler):
+            _, output_stats = dask.compute(write_job, stats_lazy)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # 檢查檔案大小
+    actual_size_mb = os.path.getsize(OUTPUT_FILE) / (1024**2)
+    print(f"    File written successfully!")
+    print(f"    File size: {actual_size_mb:.1f} MB")
+    print(f"    Dataset dimensions: {dict(output_ds.sizes)}")
 
     # 關閉資料集
     ds_eth.close()
     ds_wind.close()
-    
-    print(f"\n=== Creating output dataset ===")
-    
+
+    print(f"\n=== Output statistics ===")
+
     # 計算統計資訊
-    for var_name, data in output_arrays.items():
-        valid_data = data[~np.isnan(data)]
-        if len(valid_data) > 0:
-            print(f"    {var_name}: range [{np.min(valid_data):.2e}, {np.max(valid_data):.2e}], valid: {len(valid_data)}/{data.size}")
+    for var_name, (vmin, vmax, n_nan) in output_stats.items():
+        size = output_ds[var_name].size
+        n_valid = size - int(n_nan)
+        if n_valid > 0:
+            print(f"    {var_name}: range [{vmin:.2e}, {vmax:.2e}], valid: {n_valid}/{size}")
         else:
             print(f"    {var_name}: No valid data!")
-
-    # 建立輸出dataset
-    try:
-        output_ds = xr.Dataset(
-            coords={
-                'member': members,
-                'Time': times,
-                'level': LEVELS,
-                'XLAT': (['south_north', 'west_east'], lats.magnitude),
-                'XLONG': (['south_north', 'west_east'], lons.magnitude),
-            }
-        )
-        
-        # 定義變數配置和單位
-        var_configs = {
-            'eth': ('K', 'Equivalent potential temperature'),
-            'dtedx': ('K/m', 'Zonal gradient of equivalent potential temperature'),
-            'dtedy': ('K/m', 'Meridional gradient of equivalent potential temperature'),
-            'absthe': ('K/m', 'Absolute gradient of equivalent potential temperature'),
-            'divg': ('1/s', 'Horizontal divergence'),
-            'vort': ('1/s', 'Relative vorticity')
-        }
-        
-        dims_5d = ['member', 'Time', 'level', 'south_north', 'west_east']
-        
-        # 加入所有變數
-        for var_name, (units_str, long_name) in var_configs.items():
-            output_ds[var_name] = (dims_5d, output_arrays[var_name])
-            output_ds[var_name].attrs = {
-                'units': units_str,
-                'long_name': long_name,
-                'pressure_levels': f"{LEVELS} hPa"
-            }
-            print(f"    Added variable: {var_name}")
-
-        # 加入全域屬性
-        output_ds.attrs.update({
-            'title': f'Multi-level equivalent potential temperature analysis',
-            'description': f'Derived meteorological variables from WRF data at {LEVELS} hPa levels',
-            'source': f'Processed from {INPUT_DIR}',
-            'pressure_levels': f'{LEVELS} hPa',
-            'processing_date': np.datetime64('now').astype(str),
-            'levels_processed': len(LEVELS),
-            'processing_method': 'Iterative member-time-level processing for memory efficiency'
-        })
-
-        print(f"    Writing to NetCDF file: {OUTPUT_FILE}")
-        
-        # 設定編碼格式
-        encoding = {var: {'dtype': 'float32', 'zlib': False, 'complevel': 0} for var in output_ds.data_vars}
-        output_ds.to_netcdf(OUTPUT_FILE, encoding=encoding)
-
-        # 檢查檔案大小
-        actual_size_mb = os.path.getsize(OUTPUT_FILE) / (1024**2)
-        print(f"    File written successfully!")
-        print(f"    File size: {actual_size_mb:.1f} MB")
-        print(f"    Dataset dimensions: {dict(output_ds.sizes)}")
-
-    except Exception as e:
-        print(f"    Error writing output: {e}")
-        raise
     
 #=========================================================================
 # == MAIN ==
@@ -219,6 +327,7 @@ def process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVELS):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute theta_e")
     parser.add_argument("-L", "--level", type=int, nargs='+', default=[875, 850, 825 ], help="氣壓層 (hPa)，可輸入多個")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="平行處理成員的行程數")
     args = parser.parse_args()
 
     LEVEL = args.level
@@ -227,7 +336,7 @@ if __name__ == "__main__":
 
     INPUT_DIR= f'./extract_wrf_to_nc'
     OUTPUT_FILE = f'{OUTPUT_DIR}/the_gra.nc'  
-    process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVEL)
+    process_multiple_levels_iterative(INPUT_DIR, OUTPUT_FILE, LEVEL, args.workers)
 
     print("\nAll processing completed successfully!")
     # breakpoint()
@@ -24,9 +24,12 @@ import numpy as np
 import xarray as xr
 import metpy.calc as mpcalc
 from metpy.units import units
+import matplotlib
+matplotlib.use('Agg')  # 批次繪圖，不需 GUI backend
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
+from grid_cache import load_grid_deltas
 import os
 
 # =================================================================================================
@@ -77,8 +80,8 @@ lats = ds_theta['latitude']   # 緯度 [degrees_north]
 times = ds_theta['XTIME']     # 時間座標
 
 # 計算格點間距 (用於梯度計算)
-# MetPy函數自動處理球面座標系統的格點間距計算
-dx, dy = mpcalc.lat_lon_grid_deltas(lons, lats)
+# MetPy函數自動處理球面座標系統的格點間距計算；網格固定，由 grid_cache 快取於 ./cache 重複使用
+dx, dy = load_grid_deltas(lons, lats)
 
 print(f"Grid information:")
 print(f"    Longitude range: {float(lons.min()):.2f}° to {float(lons.max()):.2f}°")
@@ -98,10 +101,19 @@ v_wind = ds_winds['va'].sel(vertical=PRESSURE_LEVEL, member=ENSEMBLE_MEMBER)   #
 print(f"Field extraction complete. Data type: {type(theta)}")
 print(f"Time steps available: {len(theta.time)}")
 
-# 格點間距維度擴展 (配合3D場維度: time, y, x)
-n_times = len(theta.time)
-dx_3d = np.tile(dx[np.newaxis, :, :], (n_times, 1, 1)) 
-dy_3d = np.tile(dy[np.newaxis, :, :], (n_times, 1, 1)) 
+# 定義時間窗口 (前後1小時)
+time_before = TARGET_TIME - np.timedelta64(1, 'h')  # t-1hr
+time_after = TARGET_TIME + np.timedelta64(1, 'h')   # t+1hr
+
+# 僅擷取需要的時間點 (鋒生函數只需目標時間，趨勢只需前後兩個時間)
+theta_target = theta.sel(time=TARGET_TIME)
+u_target = u_wind.sel(time=TARGET_TIME)
+v_target = v_wind.sel(time=TARGET_TIME)
+theta_pair = theta.sel(time=[time_before, time_after])
+
+# 格點間距加上時間維度 (view，不複製資料；依廣播配合3D場維度: time, y, x)
+dx_3d = dx[np.newaxis, :, :]
+dy_3d = dy[np.newaxis, :, :]
 
 print(f"Grid spacing arrays:")
 print(f"    dx_3d shape: {dx_3d.shape}, units: {dx_3d.units}")
@@ -112,10 +124,10 @@ print(f"    dy_3d shape: {dy_3d.shape}, units: {dy_3d.units}")
 # =================================================================================================
 print(f"\nComputing frontogenesis using MetPy...")
 
-# MetPy鋒生函數
+# MetPy鋒生函數 (目標時間2D場)
 frontogenesis_field = mpcalc.frontogenesis(
-    theta, u_wind, v_wind, 
-    dx=dx_3d, dy=dy_3d
+    theta_target, u_target, v_target, 
+    dx=dx, dy=dy
 )
 
 print(f"Frontogenesis computation complete.")
@@ -127,25 +139,25 @@ print(f"    Units: {frontogenesis_field.data.units}")
 # =================================================================================================
 print(f"\nComputing tendency of equivalent potential temperature gradient magnitude...")
 
-# 計算位溫的空間梯度
+# 計算位溫的空間梯度 (僅前後兩個時間)
 dtheta_dx, dtheta_dy = mpcalc.geospatial_gradient(
-    theta, dx=dx_3d, dy=dy_3d
+    theta_pair, dx=dx_3d, dy=dy_3d
 )
 
 # 計算梯度強度 |∇θe|
 gradient_magnitude = np.sqrt(dtheta_dx**2 + dtheta_dy**2)
 
-# 定義時間窗口 (前後1小時)
-time_before = TARGET_TIME - np.timedelta64(1, 'h')  # t-1hr
-time_after = TARGET_TIME + np.timedelta64(1, 'h')   # t+1hr
-
 print(f"Time difference calculation:")
 print(f"    Before: {time_before}")
 print(f"    Target: {TARGET_TIME}")
 print(f"    After: {time_after}")
 
 # 計算梯度強度的時間趨勢 d|∇θe|/dt
-gradient_change = gradient_magnitude[theta.time==time_after, :, :] - gradient_magnitude[theta.time==time_before, :, :]
+# (MetPy 回傳 pint Quantity，無 .sel，改以時間標籤查得整數索引)
+time_index = theta_pair.indexes['time']
+gradient_after = gradient_magnitude[time_index.get_loc(time_after)]
+gradient_before = gradient_magnitude[time_index.get_loc(time_before)]
+gradient_change = gradient_after - gradient_before
 
 # 時間間隔 (2小時 = 7200秒)
 time_interval = (time_after - time_before) / np.timedelta64(1, 's') * units.second
@@ -163,12 +175,9 @@ print(f"    Time interval: {time_interval}")
 # =================================================================================================
 print(f"\nExtracting data at target time and converting units...")
 
-# 擷取目標時間的鋒生函數值
-frontogenesis_target = frontogenesis_field.sel(time=TARGET_TIME)
-
 # 單位轉換為 [K/(km·hr)] 每小時每公里的溫度梯度變化
 gradient_tendency_converted = gradient_tendency.to('kelvin / kilometer / hour')
-frontogenesis_converted = frontogenesis_target.data.to('kelvin / kilometer / hour')
+frontogenesis_converted = frontogenesis_field.data.to('kelvin / kilometer / hour')
 
 # 資料統計資訊
 print(f"Converted data statistics:")
@@ -252,7 +261,8 @@ plt.tight_layout()
 
 # 儲存高解析度圖形
 output_filename = f'{OUTPUT_DIR}/frontogenesis_tendency_comparison_{TARGET_TIME}.png'
-plt.savefig(output_filename, dpi=DPI, bbox_inches='tight')
+fig.savefig(output_filename, dpi=DPI, bbox_inches='tight')
+plt.close(fig)
 
 print("===================================================")
 print(f"Analysis complete!")
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+WRF 網格間距 (mpcalc.lat_lon_grid_deltas) 的磁碟快取
+
+calc_WRF_ThetaE_Analysis.py 與 frontogenesis_tendency_comparison.py 共用，
+以相同的經緯度雜湊鍵讀寫 {cache_dir}/dxdy_<hash>.npz
+
+Author: CYC(YakultSmoothie)
+"""
+#==================================================================================================
+import numpy as np
+import metpy.calc as mpcalc
+from metpy.units import units
+import hashlib
+import os
+import tempfile
+#=========================================================================
+
+def _degrees(coord):
+    """
+    經緯度轉為 float64 [degree] 連續陣列（pint Quantity 先換算單位；DataArray/ndarray 視為 degree）
+    """
+    if hasattr(coord, 'm_as'):
+        coord = coord.m_as('degree')
+    return np.ascontiguousarray(coord, dtype=np.float64)
+
+
+def load_grid_deltas(lons, lats, cache_dir='./cache'):
+    """
+    計算網格間距 (mpcalc.lat_lon_grid_deltas)，並依經緯度雜湊快取於 cache_dir
+    
+    WRF 網格固定，重複執行時直接讀取 {cache_dir}/dxdy_<hash>.npz
+    
+    Parameters:
+    -----------
+    lons, lats : pint.Quantity, xarray.DataArray or ndarray
+        經緯度 (y, x)
+    cache_dir : str
+        快取目錄
+    
+    Returns:
+    --------
+    dx, dy : pint.Quantity [m]
+    """
+    grid_hash = hashlib.md5(_degrees(lons).tobytes() + _degrees(lats).tobytes()).hexdigest()[:12]
+    cache_file = f'{cache_dir}/dxdy_{grid_hash}.npz'
+
+    if os.path.exists(cache_file):
+        print(f"    Loading cached grid spacing: {cache_file}")
+        with np.load(cache_file) as cached:
+            return cached['dx'] * units('m'), cached['dy'] * units('m')
+
+    dx, dy = mpcalc.lat_lon_grid_deltas(lons, lats)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # 先寫入暫存檔再原子性更名，避免同時執行的程式讀到寫到一半的檔案；寫入失敗時移除暫存檔
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz', delete=False) as tmp:
+        try:
+            np.savez(tmp, dx=dx.m_as('m'), dy=dy.m_as('m'))
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.replace(tmp.name, cache_file)
+    print(f"    Cached grid spacing: {cache_file}")
+    return dx, dy
+
+#==================================================================================================